@@ -0,0 +1,222 @@
+"""Бенчмарк пайплайна на синтетическом tar-архиве в формате GEO.
+
+Генерирует '<dataset_name>_RAW.tar' с заданным числом образцов и проб, отдает его с локального диска
+или через локальный HTTP-сервер и прогоняет пайплайн от скачивания до CleanupProjectTask.
+Метрики задач собираются в JSON Lines и сводятся по стадиям.
+
+Пример:
+    python benchmark.py --samples 50 --probes 48000 --source http --workers 4 --report bench.json
+"""
+import argparse
+import collections
+import gzip
+import http.server
+import io
+import json
+import os
+import random
+import re
+import shutil
+import tarfile
+import threading
+import time
+
+import luigi
+
+import bondareva_pipeline as pipeline
+
+# Колонки секции Probes, как в файлах Illumina HumanHT-12
+PROBE_COLUMNS = ['Species', 'Source', 'Search_Key', 'Transcript', 'ILMN_Gene', 'Source_Reference_ID',
+                 'RefSeq_ID', 'Unigene_ID', 'Entrez_Gene_ID', 'GI', 'Accession', 'Symbol', 'Protein_Product',
+                 'Probe_Id', 'Array_Address_Id', 'Probe_Type', 'Probe_Start', 'Probe_Sequence', 'Chromosome',
+                 'Probe_Chr_Orientation', 'Probe_Coordinates', 'Cytoband', 'Definition', 'Ontology_Component',
+                 'Ontology_Process', 'Ontology_Function', 'Synonyms', 'Obsolete_Probe_Id', 'GB_ACC']
+CONTROL_COLUMNS = ['Probe_Id', 'Array_Address_Id', 'Reporter_Group_Name', 'Reporter_Group_id', 'Reporter_Composite_map']
+
+
+# Общая для всех образцов часть файла: секции Heading, Probes и Controls
+def platform_sections(probes, rng):
+    lines = ['[Heading]',
+             'Descriptor File Name\tHumanHT-12_V4_0_R2_15002873_B.bgx',
+             f'Number of Probes\t{probes}',
+             'Number of Controls\t20',
+             '[Probes]',
+             '\t'.join(PROBE_COLUMNS)]
+    for i in range(probes):
+        symbol = f'GENE{rng.randrange(20000)}'
+        values = {
+            'Species': 'Homo sapiens',
+            'Source': rng.choice(['RefSeq', 'UniGene', 'ILMN_Cons']),
+            'Symbol': symbol,
+            'Entrez_Gene_ID': str(rng.randrange(10 ** 6)),
+            'GI': str(rng.randrange(10 ** 9)),
+            'ILMN_Gene': symbol,
+            'Probe_Id': f'ILMN_{1343291 + i}',
+            'Array_Address_Id': str(rng.randrange(10 ** 7)),
+            'Probe_Type': rng.choice(['S', 'A', 'I']),
+            'Probe_Start': str(rng.randrange(5000)),
+            'Probe_Sequence': ''.join(rng.choice('ACGT') for _ in range(50)),
+            'Chromosome': str(rng.randrange(1, 23)),
+            'Definition': f'Homo sapiens {symbol} mRNA, synthetic transcript variant {i}',
+            'Ontology_Component': 'membrane [goid 16020] [evidence IEA]',
+            'Ontology_Process': 'signal transduction [goid 7165] [evidence IEA]',
+            'Ontology_Function': 'protein binding [goid 5515] [evidence IPI]',
+        }
+        lines.append('\t'.join(values.get(c, f'{c}_{i % 97}') for c in PROBE_COLUMNS))
+    lines.append('[Controls]')
+    lines.append('\t'.join(CONTROL_COLUMNS))
+    for i in range(20):
+        lines.append(f'ILMN_{i}\t{rng.randrange(10 ** 7)}\thousekeeping\tgroup{i % 4}\tmap{i}')
+    return ('\n'.join(lines) + '\n').encode()
+
+
+# Секция Data одного образца: сигнал и p-value детекции для каждой пробы
+def data_section(probes, rng):
+    lines = ['[Data]', 'ID_REF\tVALUE\tDetection Pval']
+    for i in range(probes):
+        lines.append(f'ILMN_{1343291 + i}\t{rng.lognormvariate(5, 1.5):.3f}\t{rng.random():.5f}')
+    return ('\n'.join(lines) + '\n').encode()
+
+
+# Создает синтетический '<dataset_name>_RAW.tar': по одному gz-вложению на образец
+def make_archive(path, samples, probes, seed=0):
+    rng = random.Random(seed)
+    platform = platform_sections(probes, rng)
+    with tarfile.open(path, 'w') as tar:
+        for k in range(samples):
+            body = gzip.compress(platform + data_section(probes, rng), mtime=0)
+            member = tarfile.TarInfo(f'GSM{2000000 + k}_sample{k}_non-normalized.txt.gz')
+            member.size = len(body)
+            tar.addfile(member, io.BytesIO(body))
+
+
+# Локальная замена сервера GEO: отдает файлы из папки по имени, поддерживает HTTP Range
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+    root = '.'
+
+    def do_GET(self):
+        path = os.path.join(self.root, os.path.basename(self.path))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start = 0
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if start >= size:
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            shutil.copyfileobj(f, self.wfile)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_archives(root):
+    handler = type('Handler', (ArchiveHandler,), {'root': root})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Сводит метрики задач по стадиям (по имени класса задачи)
+def summarize(metrics_path, archive_size):
+    stages = collections.OrderedDict()
+    with open(metrics_path, 'r') as f:
+        for line in f:
+            m = json.loads(line)
+            stage = stages.setdefault(m['task'], {'tasks': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'bytes_read': 0,
+                                                  'bytes_written': 0, 'bytes_downloaded': 0, 'peak_rss_kb': 0,
+                                                  'rows_parsed': 0})
+            stage['tasks'] += 1
+            for key in ('wall_time', 'cpu_time', 'bytes_read', 'bytes_written', 'bytes_downloaded', 'rows_parsed'):
+                stage[key] += m[key] or 0
+            stage['peak_rss_kb'] = max(stage['peak_rss_kb'], m['peak_rss_kb'] or 0)
+    for stage in stages.values():
+        # Пропускная способность в пересчете на размер исходного архива
+        stage['archive_mb_per_s'] = archive_size / 2 ** 20 / stage['wall_time'] if stage['wall_time'] else None
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--probes', type=int, default=48000)
+    parser.add_argument('--source', choices=['disk', 'http'], default='http')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output-format', choices=list(pipeline.SECTION_EXTENSIONS), default='tsv')
+    parser.add_argument('--fused', action='store_true', help='прогнать FusedPipelineTask вместо Шагов 2a-4')
+    parser.add_argument('--dataset-name', default='GSE99999')
+    parser.add_argument('--work-dir', default='bench')
+    parser.add_argument('--report', default=None, help='куда сохранить сводку в JSON')
+    args = parser.parse_args()
+
+    # Каждый прогон начинается с чистой папки
+    shutil.rmtree(args.work_dir, ignore_errors=True)
+    archive_dir = os.path.join(args.work_dir, 'archive')
+    data_dir = os.path.join(args.work_dir, 'data')
+    os.makedirs(archive_dir)
+    os.makedirs(data_dir)
+
+    archive_path = os.path.join(archive_dir, f'{args.dataset_name}_RAW.tar')
+    make_archive(archive_path, args.samples, args.probes)
+    archive_size = os.path.getsize(archive_path)
+
+    config = luigi.configuration.get_config()
+    metrics_path = os.path.join(args.work_dir, 'metrics.jsonl')
+    config.set('task_metrics', 'path', metrics_path)
+
+    server = None
+    if args.source == 'http':
+        server = serve_archives(archive_dir)
+        config.set('DownloadDataset', 'base_url', f'http://127.0.0.1:{server.server_port}')
+    else:
+        # Архив уже "скачан": кладем его в data_dir вместе с файлом контрольной суммы
+        download = pipeline.DownloadDataset(data_dir=data_dir, dataset_name=args.dataset_name,
+                                            dataset_series=pipeline.series_prefix(args.dataset_name))
+        shutil.copyfile(archive_path, download.output().path)
+        with open(download.checksum_path(), 'w') as f:
+            f.write(f'{pipeline.file_sha256(archive_path).hexdigest()} {archive_size}\n')
+
+    params = dict(data_dir=data_dir, dataset_name=args.dataset_name,
+                  dataset_series=pipeline.series_prefix(args.dataset_name), output_format=args.output_format)
+    started = time.perf_counter()
+    if args.fused:
+        tasks = [pipeline.FusedPipelineTask(**params)]
+    else:
+        tasks = [pipeline.BuildExpressionMatrix(**params), pipeline.CleanupProjectTask(**params)]
+    ok = luigi.build(tasks, workers=args.workers, local_scheduler=True)
+    total_wall_time = time.perf_counter() - started
+    if server is not None:
+        server.shutdown()
+
+    report = {'samples': args.samples, 'probes': args.probes, 'source': args.source, 'workers': args.workers,
+              'fused': args.fused,
+              'output_format': args.output_format, 'archive_bytes': archive_size, 'success': ok,
+              'total_wall_time': total_wall_time, 'stages': summarize(metrics_path, archive_size)}
+
+    print(f"{'stage':<24}{'tasks':>6}{'wall, s':>10}{'cpu, s':>10}{'read, MB':>10}{'written, MB':>13}{'net, MB':>9}"
+          f"{'rows':>11}{'peak RSS, MB':>14}{'MB/s':>9}")
+    for name, stage in report['stages'].items():
+        print(f"{name:<24}{stage['tasks']:>6}{stage['wall_time']:>10.2f}{stage['cpu_time']:>10.2f}"
+              f"{stage['bytes_read'] / 2 ** 20:>10.1f}{stage['bytes_written'] / 2 ** 20:>13.1f}"
+              f"{stage['bytes_downloaded'] / 2 ** 20:>9.1f}"
+              f"{stage['rows_parsed']:>11}{stage['peak_rss_kb'] / 1024:>14.1f}{stage['archive_mb_per_s'] or 0:>9.1f}")
+    print(f"total: {total_wall_time:.2f} s, archive {archive_size / 2 ** 20:.1f} MB")
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,56 +3,344 @@ import requests
 import os
 import tarfile
 import gzip  
+import hashlib
 import shutil
+import numpy as np
 import pandas as pd
 import io
+import re
+import functools
+import contextlib
+from requests.adapters import HTTPAdapter
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import logging
+import resource
+import time
 
 logger = logging.getLogger('luigi-interface')
 
+
+# Настройки метрик задач (секция [task_metrics] в luigi.cfg)
+class task_metrics(luigi.Config):
+    # Файл, в который дописываются метрики задач в формате JSON Lines (по умолчанию метрики только пишутся в лог)
+    path = luigi.OptionalParameter(default=None)
+
+
+# Прочитанные и записанные процессом байты (файлы и сеть) из /proc/self/io; None, если он недоступен
+def io_counters():
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+# Сбрасывает пиковый RSS процесса (VmHWM), чтобы измерить пик одной задачи; False, если сброс недоступен
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# Пиковый RSS в килобайтах: VmHWM после сброса в начале задачи, иначе пик всего процесса (ru_maxrss в Linux -- в КБ)
+def peak_rss_kb(reset):
+    if reset:
+        try:
+            with open('/proc/self/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except (OSError, ValueError):
+            pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@luigi.Task.event_handler(luigi.Event.START)
+def start_task_metrics(task):
+    task.metrics_start = (time.perf_counter(), time.process_time(), io_counters(), reset_peak_rss())
+
+
+# Метрики задачи: время, процессорное время, прочитанные/записанные байты, пиковый RSS задачи и число разобранных строк
+@luigi.Task.event_handler(luigi.Event.SUCCESS)
+@luigi.Task.event_handler(luigi.Event.FAILURE)
+def emit_task_metrics(task, *args):
+    if not hasattr(task, 'metrics_start'):
+        return
+    wall_start, cpu_start, io_start, rss_reset = task.metrics_start
+    io_end = io_counters()
+    metrics = {
+        'task': task.task_family,
+        'task_id': task.task_id,
+        'status': 'failure' if args else 'success',
+        'wall_time': time.perf_counter() - wall_start,
+        'cpu_time': time.process_time() - cpu_start,
+        'bytes_read': io_end[0] - io_start[0] if io_start and io_end else None,
+        'bytes_written': io_end[1] - io_start[1] if io_start and io_end else None,
+        'peak_rss_kb': peak_rss_kb(rss_reset),
+        'rows_parsed': getattr(task, 'rows_parsed', None),
+        # Сетевые байты не попадают в /proc/self/io, поэтому задача скачивания считает их сама
+        'bytes_downloaded': getattr(task, 'bytes_downloaded', None),
+    }
+    line = json.dumps(metrics)
+    logger.info(f'Метрики задачи: {line}')
+    metrics_path = task_metrics().path
+    if metrics_path:
+        with open(metrics_path, 'a') as f:
+            f.write(line + '\n')
+
+# Считает sha256 файла по кусочкам, чтобы не держать весь файл в памяти
+def file_sha256(path, chunk_size=1024 * 1024, hasher=None):
+    hasher = hasher or hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher
+
+
+# Сессия HTTP с повторами при ошибках соединения. Сессия своя у каждого процесса: с '--workers 1' скачивания
+# переиспользуют соединение с сервером GEO, а с '--workers N' каждая задача идет в своем процессе и открывает свое
+@functools.lru_cache(maxsize=None)
+def http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=3)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Префикс серии GEO по названию датасета: GSE68849 -> GSE68nnn, GSE123 -> GSEnnn
+def series_prefix(dataset_name):
+    match = re.fullmatch(r'GSE(\d+)', dataset_name)
+    if match is None:
+        raise ValueError(f"Unexpected dataset name: {dataset_name}")
+    return f"GSE{match.group(1)[:-3]}nnn"
+
+
 # Шаг 1: Задача на скачивание данных
 class DownloadDataset(luigi.Task):
     data_dir = luigi.Parameter(default='data')
     dataset_series = luigi.Parameter(default='GSE68nnn')
     dataset_name = luigi.Parameter(default='GSE68849')
+    # Базовый адрес GEO, можно подменить на локальный HTTP-сервер
+    base_url = luigi.Parameter(default='https://ftp.ncbi.nlm.nih.gov/geo/series', significant=False)
+    # Размер куска при потоковом скачивании (байт)
+    chunk_size = luigi.IntParameter(default=1024 * 1024, significant=False)
+    # Пересчитывать ли sha256 всего архива в complete() (дорого для больших архивов)
+    verify_checksum = luigi.BoolParameter(default=False, significant=False)
+    # Одновременных скачиваний не больше, чем задано в конфиге luigi: [resources] geo_download=N (по умолчанию 1)
+    resources = {'geo_download': 1}
+    bytes_downloaded = 0  # Для метрик задачи
 
     def output(self):
         # Аутпут
         return luigi.LocalTarget(os.path.join(self.data_dir, f"{self.dataset_name}_RAW.tar"))
 
+    def checksum_path(self):
+        # Файл с контрольной суммой и размером скачанного архива: '<sha256> <size>'
+        return self.output().path + '.sha256'
+
+    def part_path(self):
+        # Недокачанный архив, с которого можно продолжить скачивание
+        return self.output().path + '.part'
+
+    def validator_path(self):
+        # ETag или Last-Modified, с которыми сервер отдал недокачанный архив (для заголовка If-Range)
+        return self.part_path() + '.validator'
+
+    def read_checksum(self):
+        # Возвращает (sha256, размер) из файла контрольной суммы или None, если его нет или он поврежден
+        try:
+            with open(self.checksum_path(), 'r') as f:
+                digest, size = f.read().split()
+            return digest, int(size)
+        except (OSError, ValueError):
+            return None
+
+    def url(self):
+        # Строим URL исходя из названия серии и датасета
+        return f"{self.base_url}/{self.dataset_series}/{self.dataset_name}/suppl/{self.dataset_name}_RAW.tar"
+
     def run(self):
         # Создает директорию для скачивания, если она не существует
         os.makedirs(self.data_dir, exist_ok=True)
-        # Строим URL исходя из названия серии и датасета
-        url = f"https://ftp.ncbi.nlm.nih.gov/geo/series/{self.dataset_series}/{self.dataset_name}/suppl/{self.dataset_name}_RAW.tar"
-        # Cкачиваем
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            with open(self.output().path, 'wb') as f:
-                f.write(response.content)
+        part_path = self.part_path()
+
+        # Если есть недокачанный файл, продолжаем с его конца (HTTP Range). If-Range гарантирует, что докачка
+        # идет от того же файла: если архив на сервере изменился, сервер отдаст его целиком (200)
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        validator = None
+        if offset and os.path.isfile(self.validator_path()):
+            with open(self.validator_path(), 'r') as f:
+                validator = f.read().strip()
+        # Без ETag/Last-Modified нельзя проверить, что .part от той же версии архива -- качаем заново
+        headers = {'Range': f'bytes={offset}-', 'If-Range': validator} if validator else {}
+        response = http_session().get(self.url(), stream=True, headers=headers, timeout=60)
+
+        if headers and response.status_code == 416:
+            # Сервер не может отдать запрошенный диапазон -- качаем заново
+            response.close()
+            response = http_session().get(self.url(), stream=True, timeout=60)
+
+        if headers and response.status_code == 206:
+            # Сервер поддерживает докачку: хеш досчитываем с уже скачанной части
+            hasher = file_sha256(part_path, self.chunk_size)
+            mode = 'ab'
+        elif response.status_code == 200:
+            # Сервер отдал файл целиком -- начинаем с нуля и запоминаем версию архива для следующей докачки
+            hasher = hashlib.sha256()
+            offset = 0
+            mode = 'wb'
+            validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+            if validator:
+                with open(self.validator_path(), 'w') as f:
+                    f.write(validator + '\n')
+            elif os.path.isfile(self.validator_path()):
+                os.remove(self.validator_path())
         else:
+            response.close()
             raise Exception(f"Failed to download file with status code {response.status_code}")
 
+        # Ожидаемый полный размер архива, если сервер его сообщил
+        content_length = response.headers.get('Content-Length')
+        expected_size = offset + int(content_length) if content_length is not None else None
+
+        # Cкачиваем по кусочкам, одновременно считая хеш, память ограничена размером куска
+        with response, open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                if chunk:
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    self.bytes_downloaded += len(chunk)
+
+        size = os.path.getsize(part_path)
+        if expected_size is not None and size != expected_size:
+            # Соединение оборвалось -- .part остается для докачки при следующем запуске
+            raise Exception(f"Incomplete download: got {size} of {expected_size} bytes")
+
+        # Сначала сохраняем контрольную сумму, затем атомарно переименовываем архив
+        with open(self.checksum_path(), 'w') as f:
+            f.write(f"{hasher.hexdigest()} {size}\n")
+        os.replace(part_path, self.output().path)
+        if os.path.isfile(self.validator_path()):
+            os.remove(self.validator_path())
+
     def complete(self):
-        # Проверяем, что скачался непустой tar-архив, только в этом случае завершаем задачу
+        # Проверяем, что скачался tar-архив с тем размером и хешем, которые мы записали при скачивании
         checking_file_path = self.output().path
-        if os.path.isfile(checking_file_path):
-            checking_file_size = os.stat(checking_file_path).st_size
-            # Не знаю, какой вес пустого архива, пусть будет 0 байт
-            if os.path.splitext(checking_file_path)[1] == '.tar' and checking_file_size != 0:
-                logger.info(f'Размер скачанного датасета: {checking_file_size} байт')
-                return True
-        return False
+        checksum = self.read_checksum()
+        if not os.path.isfile(checking_file_path) or checksum is None:
+            return False
+        if os.path.splitext(checking_file_path)[1] != '.tar':
+            return False
+        digest, size = checksum
+        checking_file_size = os.stat(checking_file_path).st_size
+        if size == 0 or checking_file_size != size:
+            return False
+        if self.verify_checksum and file_sha256(checking_file_path, self.chunk_size).hexdigest() != digest:
+            return False
+        logger.info(f'Размер скачанного датасета: {checking_file_size} байт')
+        return True
 
 
 # Результат Шага 1: мы скачали датасет в формате tar-архива в папку 'data' и дали ему название: '{dataset_name}_RAW'.
 
 
+# sha256 скачанного архива датасета из файла контрольной суммы (None, если архив еще не скачан)
+def archive_hash(data_dir, dataset_name, dataset_series):
+    checksum = DownloadDataset(data_dir=data_dir, dataset_name=dataset_name, dataset_series=dataset_series).read_checksum()
+    return checksum[0] if checksum else None
+
+
+# Манифест стадии -- json-файл вида:
+# {'input_hash': хеш входа стадии, 'params': параметры, 'archive_hash': sha256 исходного архива,
+#  'artifacts': {путь: {'size', 'mtime', 'input_hash'}}}
+# Записывается атомарно, поэтому complete() достаточно прочитать один файл вместо проверки каждого артефакта.
+def read_manifest(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(target, input_hash, artifacts, params=None, archive_hash=None):
+    with target.open('w') as f:
+        json.dump({'input_hash': input_hash, 'params': params or {}, 'archive_hash': archive_hash,
+                   'artifacts': artifacts}, f, indent=1)
+
+
+# Запись об артефакте: размер и время изменения файла, а также хеш входа, из которого он получен
+def artifact_entry(path, input_hash):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'input_hash': input_hash}
+
+
+# Проверяет, что артефакт на диске не изменился с момента записи в манифест
+def artifact_unchanged(path, entry):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime']
+
+
+# Хеш содержимого стадии по путям артефактов и хешам их входов (не зависит от времени записи файлов)
+def manifest_hash(manifest):
+    if manifest is None:
+        return None
+    items = sorted((path, entry['input_hash']) for path, entry in manifest['artifacts'].items())
+    return hashlib.sha256(json.dumps(items).encode()).hexdigest()
+
+
+# Стадия выполнена, если ее манифест записан с теми же параметрами и для того же входа.
+# Если манифест предыдущей стадии уже удален (например, в Шаге 4), сверяем хотя бы sha256 исходного архива:
+# так замена архива после очистки все равно приводит к повторной обработке.
+def manifest_complete(target, input_hash, params=None, archive_hash=None):
+    manifest = read_manifest(target.path)
+    if manifest is None or manifest.get('params', {}) != (params or {}):
+        return False
+    if archive_hash is not None and manifest.get('archive_hash') != archive_hash:
+        return False
+    return input_hash is None or manifest['input_hash'] == input_hash
+
+
+# Файловый объект, который считает sha256 всех прочитанных через него байтов
+class HashingReader(io.RawIOBase):
+    def __init__(self, f):
+        self.f = f
+        self.hasher = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self.f.readinto(buffer)
+        self.hasher.update(memoryview(buffer)[:n])
+        return n
+
+
+# Распаковывает gz-вложение из памяти сразу в итоговый txt-файл (выполняется в пуле воркеров)
+def gunzip_member(data, out_path, chunk_size=1024 * 1024):
+    with gzip.GzipFile(fileobj=io.BytesIO(data)) as f_in, open(out_path, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, chunk_size)
+    return out_path, hashlib.sha256(data).hexdigest()
+
+
 # Шаг 2a: Задача на распаковку tar-фрхива, извлечение данных.
 class UnpackTarFiles(luigi.Task):
     data_dir = luigi.Parameter(default='data')
     dataset_series = luigi.Parameter(default='GSE68nnn')
     dataset_name = luigi.Parameter(default='GSE68849')
+    # Число воркеров для распаковки gz-вложений (1 -- последовательно, без пула)
+    unpack_workers = luigi.IntParameter(default=1, significant=False)
+    # Тип пула: потоки (zlib отпускает GIL) или процессы
+    unpack_pool = luigi.ChoiceParameter(choices=['thread', 'process'], default='thread', significant=False)
 
     def requires(self):
         # Эта задача зависит от задачи скачивания
@@ -61,9 +349,9 @@ class UnpackTarFiles(luigi.Task):
                               dataset_series=self.dataset_series)
 
     def output(self):
-        # Создаем выходной файл, содержащий пути извлеченных txt-файлов
-        tmp_file = str(os.path.join(self.data_dir, self.dataset_name)) + '/tmp.txt'
-        return luigi.LocalTarget(tmp_file)
+        # Манифест стадии с путями извлеченных txt-файлов
+        manifest = os.path.join(self.data_dir, self.dataset_name, 'unpack_manifest.json')
+        return luigi.LocalTarget(manifest)
 
     def run(self):
         # Распаковка архивов
@@ -75,57 +363,316 @@ class UnpackTarFiles(luigi.Task):
         # Создает директорию, если она не существует
         os.makedirs(extract_path, exist_ok=True)
 
-        # Распаковка tar-архивов
-        # Открвааем tar-архив -- инпут для UnpackTarFiles
-        with tarfile.open(tar_path, "r") as tar:
-            # Для каждого вложения в tar-архиве
-            for member in tar.getmembers():
-                # Считываем имя каждого вложения в tar-архив
-                file_name = os.path.splitext(member.name)[0]
-                # Определяем путь для создания директории с именем каждого вложения внутри директории аутпута UnpackTarFiles
-                member_dir = os.path.join(extract_path, file_name)
-                # Создаем папку с именем вложения, если такой еще нет
-                os.makedirs(member_dir, exist_ok=True)
-                # Извлекаем содержимое вложения в эту папку
-                tar.extract(member, member_dir)
+        executor = None
+        if self.unpack_workers > 1:
+            pool_cls = ProcessPoolExecutor if self.unpack_pool == 'process' else ThreadPoolExecutor
+            executor = pool_cls(max_workers=self.unpack_workers)
+        pending = deque()  # Задачи распаковки в порядке следования вложений в архиве
+        extracted = []  # Пути извлеченных txt-файлов и хеши их gz-вложений
+
+        try:
+            # Читаем tar-архив один раз потоково, без tar.getmembers()
+            with tarfile.open(tar_path, "r|") as tar:
+                # Для каждого вложения в tar-архиве
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    # Считываем имя каждого вложения в tar-архив
+                    file_name = os.path.splitext(member.name)[0]
+                    # Определяем путь для создания директории с именем каждого вложения внутри директории аутпута UnpackTarFiles
+                    member_dir = os.path.join(extract_path, file_name)
+                    # Создаем папку с именем вложения, если такой еще нет
+                    os.makedirs(member_dir, exist_ok=True)
+                    f_in = tar.extractfile(member)
 
-                # Если вложение -- gz-архив, то распаковываем в этой же папке
-                if member.name.endswith('.gz'):
-                    with gzip.open(os.path.join(member_dir, member.name), 'rb') as f_in:
-                        with open(os.path.join(member_dir, file_name), 'wb') as f_out:
+                    if not member.name.endswith('.gz'):
+                        # Прочие вложения просто копируем в их папку
+                        with open(os.path.join(member_dir, os.path.basename(member.name)), 'wb') as f_out:
                             shutil.copyfileobj(f_in, f_out)
-                    # Удаляем gz-архив из папки аутпута
-                    os.remove(os.path.join(member_dir, member.name))
-
-                    # Записываем пути извлеченных txt-файлов во временный текстовый файл
-                    with open(self.output().path, 'a') as f:
-                        f.write(os.path.join(member_dir, file_name) + '\n')
-                        f.close()
-                        
+                        continue
+
+                    # gz-вложение распаковываем сразу в итоговый txt-файл, не сохраняя сам gz-архив
+                    out_path = os.path.join(member_dir, os.path.basename(file_name))
+                    if executor is None:
+                        f_hashed = HashingReader(f_in)
+                        with gzip.GzipFile(fileobj=f_hashed) as f_gz, open(out_path, 'wb') as f_out:
+                            shutil.copyfileobj(f_gz, f_out)
+                        extracted.append((out_path, f_hashed.hasher.hexdigest()))
+                        continue
+
+                    pending.append(executor.submit(gunzip_member, f_in.read(), out_path))
+                    # Ограничиваем число сжатых вложений в памяти
+                    while len(pending) >= 2 * self.unpack_workers:
+                        extracted.append(pending.popleft().result())
+
+            while pending:
+                extracted.append(pending.popleft().result())
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        # Записываем пути извлеченных txt-файлов в манифест одним атомарным действием
+        artifacts = {path: artifact_entry(path, member_hash) for path, member_hash in extracted}
+        write_manifest(self.output(), self.input_hash(), artifacts)
+
+    def input_hash(self):
+        # Вход стадии -- sha256 скачанного архива
+        checksum = self.requires().read_checksum()
+        return checksum[0] if checksum else None
+
     def complete(self):
-        checking_file_path = self.output().path
-        if os.path.isfile(checking_file_path):
-            all_files_ok = True  # Предполагаем, что все файлы в порядке, пока не докажем обратное
-            with open(checking_file_path, 'r') as f:
-                for line in f:
-                    extracted_file_path = line.strip()  # Удалить пробелы и символы новой строки
-                    if not os.path.isfile(extracted_file_path):
-                        all_files_ok = False  # Файл не найден
-                        break
-                    extracted_file_size = os.stat(extracted_file_path).st_size
-                    if os.path.splitext(extracted_file_path)[1] != '.txt' or extracted_file_size == 0:
-                        all_files_ok = False  # Файл не соответствует критериям
-                        break
-            return all_files_ok
-        return False
+        return manifest_complete(self.output(), self.input_hash())
+
+# Результат Шага 2a: мы разархивировали tar-архив: '{dataset_name}_RAW' в папку с названием датасета: '{dataset_name}' и внутри этой папки каждый gz-архив также разархивируется в соответствующую папку со своим содержимым. В качестве аутпута передается манифест unpack_manifest.json, содержащий пути всех разархивированных txt-файлов и хеши их gz-вложений.
+
+# Открывает файл на чтение в бинарном режиме; уже открытый файловый объект (например, io.BytesIO) отдает как есть
+def open_binary(source):
+    if hasattr(source, 'read'):
+        return contextlib.nullcontext(source)
+    return open(source, 'rb')
+
+
+# Индексирует секции txt-файла Illumina за один проход: {имя секции: (начало, конец)} в байтах.
+# Начало -- первый байт после строки '[Секция]', конец -- начало следующего заголовка или конец файла.
+def index_sections(path):
+    index = {}
+    write_key = None
+    start = offset = 0
+    with open_binary(path) as f:
+        for line in f:
+            if line.startswith(b'['):
+                if write_key:
+                    index[write_key] = (start, offset)
+                write_key = line.rstrip(b'\r\n').strip(b'[]').decode()
+                start = offset + len(line)
+            offset += len(line)
+    if write_key:
+        index[write_key] = (start, offset)
+    return index
+
+
+# Файловый объект, который отдает только байты [start, end) исходного файла -- без копирования секции в память
+class SectionReader(io.RawIOBase):
+    def __init__(self, f, start, end):
+        self.f = f
+        self.pos = start
+        self.end = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.end - self.pos)
+        if size <= 0:
+            return 0
+        self.f.seek(self.pos)
+        n = self.f.readinto(memoryview(buffer)[:size])
+        self.pos += n
+        return n
+
+
+# Компактные типы колонок известных секций Illumina: категории для повторяющихся строк, float32 для сигналов
+# и p-value, узкие целые для счетчиков. Типы колонок, которых здесь нет, pandas определяет сам.
+SECTION_SCHEMAS = {
+    'Heading': {},
+    'Probes': {
+        'Species': 'category', 'Source': 'category', 'Search_Key': 'str', 'Transcript': 'str',
+        'ILMN_Gene': 'category', 'Source_Reference_ID': 'str', 'RefSeq_ID': 'str', 'Unigene_ID': 'str',
+        'Entrez_Gene_ID': 'str', 'GI': 'str', 'Accession': 'str', 'Symbol': 'category',
+        'Protein_Product': 'str', 'Probe_Id': 'str', 'Array_Address_Id': 'Int32', 'Probe_Type': 'category',
+        'Probe_Start': 'Int32', 'Probe_Sequence': 'str', 'Chromosome': 'category',
+        'Probe_Chr_Orientation': 'category', 'Probe_Coordinates': 'str', 'Cytoband': 'category',
+        'Definition': 'str', 'Ontology_Component': 'category', 'Ontology_Process': 'category',
+        'Ontology_Function': 'category', 'Synonyms': 'str', 'Obsolete_Probe_Id': 'str', 'GB_ACC': 'str',
+    },
+    'Controls': {
+        'Probe_Id': 'str', 'Array_Address_Id': 'Int32', 'Reporter_Group_Name': 'category',
+        'Reporter_Group_id': 'category', 'Reporter_Composite_map': 'str',
+    },
+    'Data': {'ID_REF': 'str', 'PROBE_ID': 'str', 'SYMBOL': 'category'},
+}
+# Колонки с именами, зависящими от образца (например, 'GSM1234.AVG_Signal'), определяются по окончанию имени
+SECTION_DTYPE_PATTERNS = {
+    'Data': [(re.compile(r'(VALUE|AVG_Signal|BEAD_STD(ERR|EV)|Detection[ _]?Pval)$', re.IGNORECASE), 'float32'),
+             (re.compile(r'(Avg_NBEADS|NARRAYS)$', re.IGNORECASE), 'Int16')],
+}
+# Режимы типов: compact -- схемы для известных секций и автоопределение для остальных,
+# strict -- неизвестная секция считается ошибкой, infer -- везде автоопределение pandas
+DTYPE_MODES = ['compact', 'strict', 'infer']
+
+
+# Типы колонок секции по реестру схем; None -- типы определяет pandas
+def section_dtypes(name, columns=(), dtypes='compact'):
+    if dtypes == 'infer':
+        return None
+    if name not in SECTION_SCHEMAS:
+        if dtypes == 'strict':
+            raise ValueError(f"No dtype schema for section '{name}'")
+        return None
+    resolved = dict(SECTION_SCHEMAS[name])
+    for column in columns:
+        for pattern, dtype in SECTION_DTYPE_PATTERNS.get(name, []):
+            if column not in resolved and pattern.search(str(column)):
+                resolved[column] = dtype
+                break
+    return resolved
+
+
+# Читает одну секцию txt-файла в датафрейм, не пересканируя файл, если индекс уже построен.
+# dtypes -- режим типов из DTYPE_MODES (по умолчанию автоопределение pandas)
+def read_section(path, name, index=None, dtypes='infer', **kwargs):
+    index = index if index is not None else index_sections(path)
+    start, end = index[name]
+    kwargs.setdefault('sep', '\t')
+    kwargs.setdefault('header', None if name == 'Heading' else 'infer')
+    with open_binary(path) as f:
+        if 'dtype' not in kwargs:
+            # Имена колонок берем из первой строки секции, чтобы сопоставить их со схемой
+            f.seek(start)
+            columns = f.readline().decode().rstrip('\r\n').split('\t')
+            kwargs['dtype'] = section_dtypes(name, columns, dtypes)
+        reader = io.BufferedReader(SectionReader(f, start, end))
+        return pd.read_csv(reader, **kwargs)
+
+
+# Расширения файлов секций для каждого формата вывода (parquet и feather требуют установленного pyarrow)
+SECTION_EXTENSIONS = {'tsv': '.tsv', 'parquet': '.parquet', 'feather': '.feather'}
+
+
+# Сохраняет таблицу секции в выбранном формате
+def write_table(df, path, output_format='tsv'):
+    if output_format == 'tsv':
+        df.to_csv(path, sep='\t')
+        return
+    # Колоночные форматы требуют строковых имен колонок и не хранят индекс pandas
+    df = df.reset_index(drop=True)
+    df.columns = [str(c) for c in df.columns]
+    if output_format == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_feather(path)
+
+
+# Читает таблицу секции, разбирая только колонки из columns (по умолчанию все) без колонок из drop.
+# Для колоночных форматов остальные колонки вообще не читаются с диска.
+# Для tsv типы колонок задаются через dtype, колоночные форматы хранят типы сами.
+def read_table(path, drop=(), columns=None, dtype=None):
+    extension = os.path.splitext(path)[1]
+    keep = lambda c: (columns is None or c in columns) and c not in drop
+    if extension == '.tsv':
+        return pd.read_csv(path, sep='\t', usecols=keep, dtype=dtype)
+    if extension == '.parquet':
+        import pyarrow.parquet as pq
+        names = pq.read_schema(path).names
+        return pd.read_parquet(path, columns=[c for c in names if keep(c)])
+    if extension == '.feather':
+        import pyarrow.ipc
+        with pyarrow.ipc.open_file(path) as reader:
+            names = reader.schema.names
+        return pd.read_feather(path, columns=[c for c in names if keep(c)])
+    raise ValueError(f"Unknown table format: {path}")
+
+
+# Хеш сырых байтов секции -- ключ кэша одинаковых таблиц (Probes, Controls одинаковы у всех образцов серии)
+def section_digest(path, start, end, chunk_size=1024 * 1024):
+    hasher = hashlib.sha256()
+    with open_binary(path) as f:
+        reader = SectionReader(f, start, end)
+        buffer = bytearray(chunk_size)
+        n = reader.readinto(buffer)
+        while n:
+            hasher.update(memoryview(buffer)[:n])
+            n = reader.readinto(buffer)
+    return hasher.hexdigest()
+
+
+# Делает жесткую ссылку на файл (или копию, если файловая система не поддерживает ссылки)
+def link_or_copy(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+# Шаг 2b (для одного образца): Обработка одного txt-файла, разбиение на секции.
+class ProcessSampleFile(luigi.Task):
+    sample_path = luigi.Parameter()
+    # Хеш входа образца из манифеста Шага 2a: при его изменении образец обрабатывается заново
+    input_hash = luigi.Parameter(default='')
+    output_format = luigi.ChoiceParameter(choices=list(SECTION_EXTENSIONS), default='tsv')
+    # Типы колонок секций: compact, strict или infer (см. DTYPE_MODES)
+    dtypes = luigi.ChoiceParameter(choices=DTYPE_MODES, default='compact')
+    # Папка кэша одинаковых секций (None -- без кэша) и секции, которые в нем хранятся
+    cache_dir = luigi.OptionalParameter(default=None)
+    dedup_sections = luigi.ListParameter(default=['Probes', 'Controls'])
+    rows_parsed = 0  # Для метрик задачи
+
+    def output(self):
+        # Манифест tsv-файлов, созданных из этого txt-файла
+        return luigi.LocalTarget(os.path.join(os.path.dirname(self.sample_path), 'sections.json'))
+
+    def complete(self):
+        return manifest_complete(self.output(), self.input_hash, {'output_format': self.output_format, 'dtypes': self.dtypes})
+
+    def run(self):
+        # Один раз проходим по txt-файлу и запоминаем границы секций
+        index = index_sections(self.sample_path)
+        extension = SECTION_EXTENSIONS[self.output_format]
+
+        # Получаем папку, в которой находятся tsv-файлы, для создания путей
+        gz_dir = os.path.dirname(self.sample_path)
+        tsv_paths = []
+        # Читаем каждую секцию прямо из файла и сохраняем в файл выбранного формата (по умолчанию tsv)
+        for k, (start, end) in index.items():
+            tsv_file_path = os.path.join(gz_dir, k + extension)
+            tsv_paths.append(tsv_file_path)
+            # Файл мог остаться ссылкой на кэш с прошлого запуска -- не перезаписываем общий файл
+            if os.path.lexists(tsv_file_path):
+                os.remove(tsv_file_path)
+            if self.cache_dir is None or k not in self.dedup_sections:
+                df = read_section(self.sample_path, k, index, self.dtypes)
+                self.rows_parsed += len(df)
+                write_table(df, tsv_file_path, self.output_format)
+                continue
+
+            # Одинаковая секция разбирается один раз, остальные образцы получают ссылку на файл из кэша
+            cache_key = f'{section_digest(self.sample_path, start, end)}-{self.dtypes}'
+            cached_path = os.path.join(self.cache_dir, cache_key, k + extension)
+            if not os.path.isfile(cached_path):
+                os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+                tmp_path = f'{cached_path}.{os.getpid()}.tmp'
+                df = read_section(self.sample_path, k, index, self.dtypes)
+                self.rows_parsed += len(df)
+                write_table(df, tmp_path, self.output_format)
+                try:
+                    # Если параллельный воркер уже положил эту секцию в кэш, оставляем его файл
+                    os.link(tmp_path, cached_path)
+                except FileExistsError:
+                    pass
+                except OSError:
+                    os.replace(tmp_path, cached_path)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            link_or_copy(cached_path, tsv_file_path)
+
+        # Манифест записываем атомарно, только когда все секции сохранены
+        artifacts = {path: artifact_entry(path, self.input_hash) for path in tsv_paths}
+        write_manifest(self.output(), self.input_hash, artifacts, {'output_format': self.output_format, 'dtypes': self.dtypes})
 
-# Результат Шага 2a: мы разархивировали tar-архив: '{dataset_name}_RAW' в папку с названием датасета: '{dataset_name}' и внутри этой папки каждый gz-архив также разархивируется в соответствующую папку со своим содержимым. В качестве аутпута передается файл tmp.txt, содержащий пути всех разархивированных txt-файлов.
 
 # Шаг 2b: Обработка текстовых файлов, извлечение данных.
 class ProcessTextFiles(luigi.Task):
     data_dir = luigi.Parameter(default='data')
     dataset_series = luigi.Parameter(default='GSE68nnn')
     dataset_name = luigi.Parameter(default='GSE68849')
+    # Формат файлов секций: tsv, parquet или feather
+    output_format = luigi.ChoiceParameter(choices=list(SECTION_EXTENSIONS), default='tsv')
+    # Типы колонок секций: compact, strict или infer (см. DTYPE_MODES)
+    dtypes = luigi.ChoiceParameter(choices=DTYPE_MODES, default='compact')
+    # Секции, одинаковые у всех образцов серии: разбираются один раз и хранятся в кэше
+    dedup_sections = luigi.ListParameter(default=['Probes', 'Controls'], significant=False)
     
     def requires(self):
         # Зависит от успешной распаковки архивов
@@ -134,164 +681,274 @@ class ProcessTextFiles(luigi.Task):
                               dataset_series=self.dataset_series)
         
     def output(self):
-        # Создаем выходной файл, содержащий пути извлеченных tsv-файлов
-        tmp_tsv_file = str(os.path.join(self.data_dir, self.dataset_name)) + '/tmp_tsv.txt'
-        return luigi.LocalTarget(tmp_tsv_file)
+        # Манифест стадии с путями извлеченных tsv-файлов
+        manifest = os.path.join(self.data_dir, self.dataset_name, 'sections_manifest.json')
+        return luigi.LocalTarget(manifest)
     
     def run(self):
-        dfs = {} # Словарь для хранения датафреймов, созданных из разделов txt-файлов
-        # Открываем файл /tmp.txt, содержащий пути к распакованным txt-файлам в режиме чтения
+        # Читаем манифест Шага 2a, содержащий пути к распакованным txt-файлам и хеши их входов
         # Помним, что аутпут прошлого класса (UnpackTarFiles) -- инпут настоящего (ProcessTextFiles)
-        with open(self.input().path, 'r') as f:
-            for line in f:
-                extracted_file_path = line.replace('\n', '') # Убираем символы новой строки из пути, так как это создавало проблемы :) 
-
-                # Открываем каждый извлеченный txt-файл в режиме чтения (по пути аутпута UnpackTarFiles)
-                with open(extracted_file_path, 'r') as f:
-                    write_key = None
-                    fio = io.StringIO()
-
-                     # Читаем данные из txt-файла
-                    for line in f.readlines():
-                        if line.startswith('['):
-                            if write_key:
-                                fio.seek(0)
-                                header = None if write_key == 'Heading' else 'infer'
-                                dfs[write_key] = pd.read_csv(fio, sep='\t', header=header)
-                            fio = io.StringIO()
-                            write_key = line.strip('[]\n')
-                            continue
-                        if write_key:
-                            fio.write(line)
-                    fio.seek(0)
-                    dfs[write_key] = pd.read_csv(fio, sep='\t')
-
-                # Получаем папку, в которой находятся tsv-файлы, для создания путей
-                gz_dir = os.path.dirname(extracted_file_path)
-                # Сохраняем данные из dfs в tsv-файлы 
-                for k, v in dfs.items():
-                    tsv_file_path = os.path.join(gz_dir, k + '.tsv')
-                    v.to_csv(tsv_file_path, sep='\t')
-
-                    # Записываем пути извлеченных tsv-файлов во временный текстовый файл, который является аутпутом класса
-                    with open(self.output().path, 'a') as f:
-                        f.write(tsv_file_path + '\n')
-                        f.close()
+        unpacked = read_manifest(self.input().path)
+
+        # Каждый образец обрабатывается отдельной задачей: с '--workers N' luigi запускает их параллельно,
+        # при сбое перезапускается только упавший образец, а образцы с неизменившимся входом пропускаются
+        cache_dir = os.path.join(self.data_dir, self.dataset_name, 'section_cache')
+        samples = yield [ProcessSampleFile(sample_path=path,
+                                           input_hash=entry['input_hash'],
+                                           output_format=self.output_format,
+                                           dtypes=self.dtypes,
+                                           cache_dir=cache_dir,
+                                           dedup_sections=self.dedup_sections)
+                         for path, entry in unpacked['artifacts'].items()]
+
+        # Собираем артефакты всех образцов в манифест стадии, который является аутпутом класса
+        artifacts = {}
+        for sample in samples:
+            artifacts.update(read_manifest(sample.path)['artifacts'])
+        write_manifest(self.output(), manifest_hash(unpacked), artifacts, {'output_format': self.output_format, 'dtypes': self.dtypes},
+                       unpacked['input_hash'])
                                 
     def complete(self):
-        checking_file_path = self.output().path
-        if os.path.isfile(checking_file_path):
-            all_files_ok = True  # Предполагаем, что все файлы в порядке, пока не докажем обратное
-            with open(checking_file_path, 'r') as f:
-                for line in f:
-                    extracted_file_path = line.strip()  # Удалить пробелы и символы новой строки
-                    if not os.path.isfile(extracted_file_path):
-                        all_files_ok = False  # Файл не найден
-                        break
-                    extracted_file_size = os.stat(extracted_file_path).st_size
-                    if os.path.splitext(extracted_file_path)[1] != '.tsv' or extracted_file_size == 0:
-                        all_files_ok = False  # Файл не соответствует критериям
-                        break
-            return all_files_ok
-        return False
+        # Читаем только манифесты: свой и предыдущих стадий, без проверки каждого файла
+        upstream = read_manifest(self.input().path)
+        if upstream is not None and not self.requires().complete():
+            return False
+        return manifest_complete(self.output(), manifest_hash(upstream), {'output_format': self.output_format, 'dtypes': self.dtypes},
+                                 archive_hash(self.data_dir, self.dataset_name, self.dataset_series))
+
+# Результат Шага 2b: мы обработали txt-файлы, а именно обработали информацию из них и сохранили в формате tsv-файлов. Каждый файл обрабатывается отдельно с разделением на секции, данные каждой секции сохраняются в отдельные tsv-файлы. После обработки всех файлов пути к результатам (созданным tsv-файлам) сохраняются в манифесте 'sections_manifest.json'. 
+
+# Список колонок, которые необходимо удалить из таблицы Probes
+PROBES_COLUMNS_TO_REMOVE = ['Definition',
+                            'Ontology_Component',
+                            'Ontology_Process',
+                            'Ontology_Function',
+                            'Synonyms',
+                            'Obsolete_Probe_Id',
+                            'Probe_Sequence',]
 
-# Результат Шага 2b: мы обработали txt-файлы, а именно обработали информацию из них и сохранили в формате tsv-файлов. Каждый файл обрабатывается отдельно с разделением на секции, данные каждой секции сохраняются в отдельные tsv-файлы. После обработки всех файлов пути к результатам (созданным tsv-файлам) сохраняются в выходном текстовом файле '/tmp_tsv.txt', который является временным и подлежит удалению в Шаге 4. 
 
 # Шаг 3: Удаление ненужных колонок из таблицы "Probes.tsv".
 class ReduceProbesTask(luigi.Task):
     data_dir = luigi.Parameter(default='data')
     dataset_series = luigi.Parameter(default='GSE68nnn')
     dataset_name = luigi.Parameter(default='GSE68849')
+    output_format = luigi.ChoiceParameter(choices=list(SECTION_EXTENSIONS), default='tsv')
+    dtypes = luigi.ChoiceParameter(choices=DTYPE_MODES, default='compact')
+    rows_parsed = 0  # Для метрик задачи
 
     def requires(self):
         # Зависит от успешной распаковки архива 
         return ProcessTextFiles(dataset_name=self.dataset_name,
                                 data_dir=self.data_dir,
-                                dataset_series=self.dataset_series)
+                                dataset_series=self.dataset_series,
+                                output_format=self.output_format,
+                                dtypes=self.dtypes)
 
     def output(self):
-        # Определение выходного файла, который будет должен содержать пути к обработанным tsv-файлам.
-        tmp_tsv_file = str(os.path.join(self.data_dir, self.dataset_name)) + '/tmp_tsv.txt'
-        return luigi.LocalTarget(tmp_tsv_file)
+        # Манифест стадии с путями к обработанным tsv-файлам (отдельный от манифеста Шага 2b)
+        manifest = os.path.join(self.data_dir, self.dataset_name, 'reduced_manifest.json')
+        return luigi.LocalTarget(manifest)
 
     def run(self):
-        # Определяем список колонок, которые необходимо удалить из таблицы
-        columns_to_remove = ['Definition',
-                             'Ontology_Component',
-                             'Ontology_Process',
-                             'Ontology_Function',
-                             'Synonyms',
-                             'Obsolete_Probe_Id',
-                             'Probe_Sequence',]
-
-        # Чтение путей к файлам из входного файла (или аутпута прошлой задачи -- '/tmp_tsv.txt') и обработка только файла 'Probes.tsv'
-        with open(self.input().path, 'r') as f:
-            for line in f:
-                tsv_file_path = line.replace('\n', '')
-                if 'Probes.tsv' in tsv_file_path:
-                    probes_path = tsv_file_path
-                    df = pd.read_csv(probes_path, sep='\t')
-                    # Удаление заданных ранее колонок
-                    df_reduced = df.drop(columns=columns_to_remove)
-                    # Формируем путь для сохранения обработанной версии таблицы "Probes.tsv" и назовем ее "сокращенной" - Probes_reduced.tsv
-                    probes_reduced_path = os.path.dirname(probes_path) + '/Probes_reduced.tsv'
-                    # Сохраняем нашу обновленную "сокращенную" таблицу
+        sections = read_manifest(self.input().path)
+        params = {'output_format': self.output_format, 'dtypes': self.dtypes}
+        # Прошлый манифест стадии: таблицы с неизменившимся входом повторно не сокращаем.
+        # Если он записан с другими параметрами (например, другим режимом типов), сокращаем все заново
+        previous = read_manifest(self.output().path) or {'artifacts': {}}
+        if previous.get('params') != params:
+            previous = {'artifacts': {}}
+        artifacts = {}
+        # Одинаковые таблицы из кэша -- это жесткие ссылки на один файл, сокращаем каждую только один раз
+        reduced = {}
+        # Обработка только таблиц 'Probes' из манифеста прошлой задачи
+        for probes_path, entry in sections['artifacts'].items():
+            name, extension = os.path.splitext(os.path.basename(probes_path))
+            if name != 'Probes':
+                continue
+            # Формируем путь для сохранения обработанной версии таблицы "Probes" и назовем ее "сокращенной" - Probes_reduced
+            probes_reduced_path = os.path.dirname(probes_path) + '/Probes_reduced' + extension
+            previous_entry = previous['artifacts'].get(probes_reduced_path)
+            if (previous_entry and previous_entry['input_hash'] == entry['input_hash']
+                    and artifact_unchanged(probes_reduced_path, previous_entry)):
+                artifacts[probes_reduced_path] = previous_entry
+                continue
+
+            probes_stat = os.stat(probes_path)
+            file_key = (probes_stat.st_dev, probes_stat.st_ino)
+            if file_key in reduced:
+                link_or_copy(reduced[file_key], probes_reduced_path)
+            else:
+                if os.path.lexists(probes_reduced_path):
+                    os.remove(probes_reduced_path)
+                # Заданные ранее колонки не читаем вовсе, вместо удаления после чтения
+                df_reduced = read_table(probes_path, drop=PROBES_COLUMNS_TO_REMOVE,
+                                        dtype=section_dtypes('Probes', dtypes=self.dtypes))
+                self.rows_parsed += len(df_reduced)
+                # Сохраняем нашу обновленную "сокращенную" таблицу
+                if extension == '.tsv':
                     df_reduced.to_csv(probes_reduced_path, sep='\t', index=False)
+                else:
+                    write_table(df_reduced, probes_reduced_path, self.output_format)
+                reduced[file_key] = probes_reduced_path
+            artifacts[probes_reduced_path] = artifact_entry(probes_reduced_path, entry['input_hash'])
 
-                    # Добавление пути к обновленному файлу в выходной файл '/tmp_tsv.txt'
-                    with open(self.output().path, 'a') as f:
-                        f.write(probes_reduced_path + '\n')
-                        f.close()
+        # Записываем манифест стадии атомарно
+        write_manifest(self.output(), manifest_hash(sections), artifacts, params, sections.get('archive_hash'))
 
     def complete(self):
-        checking_file_path = self.output().path
-        if os.path.isfile(checking_file_path):
-            all_files_ok = True  # Предполагаем, что все файлы в порядке, пока не докажем обратное
-            with open(checking_file_path, 'r') as f:
-                for line in f:
-                    extracted_file_path = line.strip()  # Удалить пробелы и символы новой строки
-                    if not os.path.isfile(extracted_file_path):
-                        all_files_ok = False  # Файл не найден
-                        break
-                    extracted_file_size = os.stat(extracted_file_path).st_size
-                    if os.path.splitext(extracted_file_path)[1] != '.tsv' or extracted_file_size == 0:
-                        all_files_ok = False  # Файл не соответствует критериям
-                        break
-            return all_files_ok
-        return False
+        # Читаем только манифесты: свой и предыдущих стадий, без проверки каждого файла
+        upstream = read_manifest(self.input().path)
+        if upstream is not None and not self.requires().complete():
+            return False
+        return manifest_complete(self.output(), manifest_hash(upstream), {'output_format': self.output_format, 'dtypes': self.dtypes},
+                                 archive_hash(self.data_dir, self.dataset_name, self.dataset_series))
+
+# Результат Шага 3: мы обработали tsv-файлы под названием 'Probes.tsv' путем удаления некоторых колонок и сохранили обновленные файлы под названием 'Probes_reduced.tsv'. Каждый обработанный файл сохраняется отдельно в своей директории, и путь к нему записывается в манифест 'reduced_manifest.json'. 
+
+# Пути матрицы экспрессии и ее индексов (идентификаторы проб -- строки, образцов -- столбцы)
+def expression_matrix_paths(data_dir, dataset_name):
+    base_path = os.path.join(data_dir, dataset_name)
+    return (os.path.join(base_path, 'expression_matrix.npy'),
+            os.path.join(base_path, 'expression_probes.tsv'),
+            os.path.join(base_path, 'expression_samples.tsv'))
+
+
+# Открывает матрицу экспрессии без чтения в память: строка пробы или столбец образца -- срез memmap без копирования.
+# Например: matrix, probes, samples = load_expression_matrix('data', 'GSE68849'); matrix[probes.get_loc('ILMN_1343291')]
+def load_expression_matrix(data_dir, dataset_name):
+    matrix_path, probes_path, samples_path = expression_matrix_paths(data_dir, dataset_name)
+    matrix = np.load(matrix_path, mmap_mode='r')
+    probes = pd.Index(pd.read_csv(probes_path, sep='\t', dtype=str).iloc[:, 0])
+    samples = pd.Index(pd.read_csv(samples_path, sep='\t', dtype=str).iloc[:, 0])
+    return matrix, probes, samples
+
+
+# Шаг 3b: Сборка секций Data всех образцов в одну матрицу float32 (пробы x образцы).
+class BuildExpressionMatrix(luigi.Task):
+    data_dir = luigi.Parameter(default='data')
+    dataset_series = luigi.Parameter(default='GSE68nnn')
+    dataset_name = luigi.Parameter(default='GSE68849')
+    output_format = luigi.ChoiceParameter(choices=list(SECTION_EXTENSIONS), default='tsv')
+    dtypes = luigi.ChoiceParameter(choices=DTYPE_MODES, default='compact')
+    # Секция с данными образца и ее колонки: идентификатор пробы и значение сигнала
+    data_section = luigi.Parameter(default='Data')
+    probe_column = luigi.Parameter(default='ID_REF')
+    value_column = luigi.Parameter(default='VALUE')
+    rows_parsed = 0  # Для метрик задачи
+
+    def requires(self):
+        # Зависит от разбиения txt-файлов на секции
+        return ProcessTextFiles(dataset_name=self.dataset_name,
+                                data_dir=self.data_dir,
+                                dataset_series=self.dataset_series,
+                                output_format=self.output_format,
+                                dtypes=self.dtypes)
+
+    def output(self):
+        # Манифест стадии с путями матрицы и ее индексов
+        manifest = os.path.join(self.data_dir, self.dataset_name, 'expression_manifest.json')
+        return luigi.LocalTarget(manifest)
+
+    def params(self):
+        return {'output_format': self.output_format, 'dtypes': self.dtypes, 'data_section': self.data_section,
+                'probe_column': self.probe_column, 'value_column': self.value_column}
+
+    def run(self):
+        sections = read_manifest(self.input().path)
+        # Таблицы секции Data всех образцов; идентификатор образца -- начало имени его папки (GSM...)
+        tables = []
+        for path in sections['artifacts']:
+            if os.path.splitext(os.path.basename(path))[0] == self.data_section:
+                sample_dir = os.path.basename(os.path.dirname(path))
+                tables.append((sample_dir.split('_')[0], path))
+        if not tables:
+            raise Exception(f"No '{self.data_section}' sections found for {self.dataset_name}")
 
-# Результат Шага 3: мы обработали tsv-файлы под названием 'Probes.tsv' путем удаления некоторых колонок и сохранили обновленные файлы под названием 'Probes_reduced.tsv'. Каждый обработанный файл сохраняется отдельно в своей директории, и путь к нему записывается в выходной текстовый файл ''/tmp_tsv.txt', который является временным и подлежит удалению в Шаге 4. 
+        # Первый проход: читаем только колонку с идентификаторами проб и собираем их объединение в порядке появления
+        probe_ids = {}
+        for _, path in tables:
+            ids = read_table(path, columns=[self.probe_column])[self.probe_column].astype(str)
+            probe_ids.update(dict.fromkeys(ids))
+        probes = pd.Index(list(probe_ids))
+
+        # Второй проход: пишем значения каждого образца в свой столбец матрицы на диске.
+        # Матрица хранится по столбцам (fortran order), поэтому запись каждого образца последовательная.
+        matrix_path, probes_path, samples_path = expression_matrix_paths(self.data_dir, self.dataset_name)
+        tmp_path = matrix_path + '.tmp.npy'
+        matrix = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                           shape=(len(probes), len(tables)), fortran_order=True)
+        for j, (_, path) in enumerate(tables):
+            columns = [self.probe_column, self.value_column]
+            df = read_table(path, columns=columns, dtype=section_dtypes(self.data_section, columns, self.dtypes))
+            self.rows_parsed += len(df)
+            column = np.full(len(probes), np.nan, dtype=np.float32)  # Пробы, которых нет у образца, -- NaN
+            column[probes.get_indexer(df[self.probe_column].astype(str))] = df[self.value_column].to_numpy(np.float32)
+            matrix[:, j] = column
+        matrix.flush()
+        del matrix
+        os.replace(tmp_path, matrix_path)
+
+        # Индексы матрицы: идентификаторы проб (строки) и образцов (столбцы)
+        pd.DataFrame({self.probe_column: probes}).to_csv(probes_path, sep='\t', index=False)
+        pd.DataFrame({'Sample': [sample for sample, _ in tables]}).to_csv(samples_path, sep='\t', index=False)
+
+        input_hash = manifest_hash(sections)
+        artifacts = {path: artifact_entry(path, input_hash) for path in (matrix_path, probes_path, samples_path)}
+        write_manifest(self.output(), input_hash, artifacts, self.params(), sections.get('archive_hash'))
+
+    def complete(self):
+        # Читаем только манифесты: свой и предыдущих стадий, без проверки каждого файла
+        upstream = read_manifest(self.input().path)
+        if upstream is not None and not self.requires().complete():
+            return False
+        return manifest_complete(self.output(), manifest_hash(upstream), self.params(),
+                                 archive_hash(self.data_dir, self.dataset_name, self.dataset_series))
+
+# Результат Шага 3b: значения секций Data всех образцов собраны в матрицу 'expression_matrix.npy' (float32, пробы x образцы), которую можно открыть через np.load(..., mmap_mode='r') или load_expression_matrix(). Идентификаторы проб и образцов сохранены в 'expression_probes.tsv' и 'expression_samples.tsv'.
 
 # Шаг 4: Очистка проекта.
 class CleanupProjectTask(luigi.Task):
     data_dir = luigi.Parameter(default='data')
     dataset_name = luigi.Parameter(default='GSE68849')
     dataset_series = luigi.Parameter(default='GSE68nnn')
+    output_format = luigi.ChoiceParameter(choices=list(SECTION_EXTENSIONS), default='tsv')
+    dtypes = luigi.ChoiceParameter(choices=DTYPE_MODES, default='compact')
+    # Папка для 'readme.txt' (по умолчанию data_dir); в пакетном режиме у каждого датасета своя
+    readme_dir = luigi.OptionalParameter(default=None)
 
     def requires(self):
         # Зависит от успешной распаковки архива
         return ReduceProbesTask(dataset_name=self.dataset_name,
                                 data_dir=self.data_dir,
-                                dataset_series=self.dataset_series)
+                                dataset_series=self.dataset_series,
+                                output_format=self.output_format,
+                                dtypes=self.dtypes)
 
     def output(self):
         # Создает файл 'readme.txt', который будет содержать информацию об удаленных и созданных файлах
-        readme = str(self.data_dir) + '/readme.txt'
+        readme = str(self.readme_dir or self.data_dir) + '/readme.txt'
         return luigi.LocalTarget(readme)
 
     def run(self):
         created_files = [] # Список для хранения путей к созданным файлам из пайплайна
-        # Чтение списка созданных файлов из 'tmp_tsv.txt' из предыдущего шага
-        with open(self.input().path, 'r') as f:
-            for line in f:
-                created_files.append(line) # Добавляем пути к созданным файлам
+        # Чтение списка созданных файлов из манифестов Шагов 2b и 3
+        for manifest_path in (self.requires().input().path, self.input().path):
+            for path in read_manifest(manifest_path)['artifacts']:
+                created_files.append(path + '\n') # Добавляем пути к созданным файлам
         # Создадим переменную для определения полного пути        
         base_path = os.path.join(self.data_dir, self.dataset_name)
         removed_files = [] # Список для хранения путей к удаленным временным файлам
-        # Перебираем файлы в директории, удаляя все txt-файлы
+        # Манифест Шага 2a описывает txt-файлы, которые сейчас будут удалены, поэтому удаляем и его
+        unpack_manifest = os.path.join(base_path, 'unpack_manifest.json')
+        if os.path.isfile(unpack_manifest):
+            os.remove(unpack_manifest)
+            removed_files.append(os.path.basename(unpack_manifest))
+        # Перебираем файлы в директории, удаляя все txt-файлы из папок образцов
+        # (в самой папке датасета в пакетном режиме лежат readme-файлы, их не трогаем)
         for root, dirs, files in os.walk(base_path):
             for file in files:
-                if file.endswith('.txt'):  # проверяем, что файл имеет расширение '.txt'
+                if file.endswith('.txt') and root != base_path:  # проверяем, что файл имеет расширение '.txt'
                     file_path = os.path.join(root, file)
                     os.remove(file_path)  # удаляем файл
                     removed_files.append(file)  # добавляем имя файла в список удалённых
@@ -313,6 +970,9 @@ class CleanupProjectTask(luigi.Task):
             f.close()
 
     def complete(self):
+        # Предыдущие стадии должны быть выполнены для текущего архива: если архив заменили, очищаем заново
+        if not self.requires().complete():
+            return False
         # Проверяем, существует ли файл и содержит ли он информацию о созданных и удалённых файлах
         if self.output().exists():
             with open(self.output().path, 'r') as f:
@@ -320,5 +980,145 @@ class CleanupProjectTask(luigi.Task):
                 return 'Созданные файлы:' in content and 'Созданные временно и удаленные файлы:' in content
         return False
 
+# Шаги 2a-4 одним проходом: tar-вложение -> gzip -> секции -> сокращение Probes -> итоговые таблицы.
+# Промежуточные gz-, txt- и tsv-файлы не пишутся на диск, поэтому очищать после задачи нечего.
+class FusedPipelineTask(luigi.Task):
+    data_dir = luigi.Parameter(default='data')
+    dataset_series = luigi.Parameter(default='GSE68nnn')
+    dataset_name = luigi.Parameter(default='GSE68849')
+    output_format = luigi.ChoiceParameter(choices=list(SECTION_EXTENSIONS), default='tsv')
+    dtypes = luigi.ChoiceParameter(choices=DTYPE_MODES, default='compact')
+    # Секции, одинаковые у всех образцов серии: сохраняются один раз, остальные образцы получают ссылку
+    dedup_sections = luigi.ListParameter(default=['Probes', 'Controls'], significant=False)
+    # Папка для 'readme_fused.txt' (по умолчанию data_dir)
+    readme_dir = luigi.OptionalParameter(default=None)
+    rows_parsed = 0  # Для метрик задачи
+
+    def requires(self):
+        # Зависит только от скачивания архива
+        return DownloadDataset(dataset_name=self.dataset_name,
+                               data_dir=self.data_dir,
+                               dataset_series=self.dataset_series)
+
+    def output(self):
+        # Манифест итоговых таблиц. Он отдельный от аутпутов Шагов 2a-4, чтобы после совмещенного режима
+        # можно было прогнать и обычный пайплайн
+        return luigi.LocalTarget(os.path.join(self.data_dir, self.dataset_name, 'fused_manifest.json'))
+
+    def readme(self):
+        # Список созданных файлов, как 'readme.txt' в Шаге 4, но в своем файле
+        return luigi.LocalTarget(str(self.readme_dir or self.data_dir) + '/readme_fused.txt')
+
+    def params(self):
+        return {'output_format': self.output_format, 'dtypes': self.dtypes}
+
+    def run(self):
+        extract_path = os.path.join(self.data_dir, self.dataset_name)
+        os.makedirs(extract_path, exist_ok=True)
+        extension = SECTION_EXTENSIONS[self.output_format]
+        written = {}  # Уже сохраненные одинаковые секции: (имя секции, хеш секции) -> пути файлов
+        artifacts = {}
+
+        # Читаем tar-архив один раз потоково
+        with tarfile.open(self.input().path, "r|") as tar:
+            for member in tar:
+                if not member.isfile() or not member.name.endswith('.gz'):
+                    continue
+                file_name = os.path.splitext(member.name)[0]
+                member_dir = os.path.join(extract_path, file_name)
+                os.makedirs(member_dir, exist_ok=True)
+
+                # Распаковываем вложение в память: на диск не попадают ни gz-, ни txt-файл
+                f_hashed = HashingReader(tar.extractfile(member))
+                with gzip.GzipFile(fileobj=f_hashed) as f_gz:
+                    sample = io.BytesIO(f_gz.read())
+                member_hash = f_hashed.hasher.hexdigest()
+
+                index = index_sections(sample)
+                for k, (start, end) in index.items():
+                    paths = [os.path.join(member_dir, k + extension)]
+                    if k == 'Probes':
+                        # Сокращенная таблица Probes получается из уже разобранной, без повторного чтения
+                        paths.append(os.path.join(member_dir, 'Probes_reduced' + extension))
+                    for path in paths:
+                        if os.path.lexists(path):
+                            os.remove(path)
+
+                    key = (k, section_digest(sample, start, end)) if k in self.dedup_sections else None
+                    if key in written:
+                        for cached_path, path in zip(written[key], paths):
+                            link_or_copy(cached_path, path)
+                    else:
+                        df = read_section(sample, k, index, self.dtypes)
+                        self.rows_parsed += len(df)
+                        write_table(df, paths[0], self.output_format)
+                        if k == 'Probes':
+                            df_reduced = df.drop(columns=PROBES_COLUMNS_TO_REMOVE, errors='ignore')
+                            if extension == '.tsv':
+                                # Как в Шаге 3: индекс исходной таблицы остается колонкой 'Unnamed: 0'
+                                df_reduced.to_csv(paths[1], sep='\t', index_label='Unnamed: 0')
+                            else:
+                                write_table(df_reduced, paths[1], self.output_format)
+                        if key is not None:
+                            written[key] = paths
+
+                    for path in paths:
+                        artifacts[path] = artifact_entry(path, member_hash)
+
+        # Запись информации о созданных файлах в файл 'readme_fused.txt'; временных файлов в этом режиме нет
+        with self.readme().open('w') as f:
+            f.write('Созданные файлы:' + '\n')
+            for path in artifacts:
+                f.write(path + '\n')
+            f.write('\n')
+            f.write('Созданные временно и удаленные файлы:' + '\n')
+
+        # Манифест записываем последним: он означает, что задача выполнена
+        write_manifest(self.output(), self.input_hash(), artifacts, self.params())
+
+    def input_hash(self):
+        # Вход задачи -- sha256 скачанного архива
+        checksum = self.requires().read_checksum()
+        return checksum[0] if checksum else None
+
+    def complete(self):
+        return manifest_complete(self.output(), self.input_hash(), self.params())
+
+# Результат совмещенного режима: те же таблицы секций и 'Probes_reduced', что и после Шагов 2a-4, но без промежуточных файлов на диске и без обхода папок при очистке. Аутпут -- манифест 'fused_manifest.json', список созданных файлов -- в 'readme_fused.txt'.
+
+
+# Пакетный режим: несколько датасетов за один запуск.
+class ProcessSeriesBatch(luigi.WrapperTask):
+    data_dir = luigi.Parameter(default='data')
+    # Названия датасетов списком ('["GSE68849", "GSE68850"]') и/или файлом, по одному на строку
+    dataset_names = luigi.ListParameter(default=[])
+    dataset_names_file = luigi.OptionalParameter(default=None)
+    output_format = luigi.ChoiceParameter(choices=list(SECTION_EXTENSIONS), default='tsv')
+    dtypes = luigi.ChoiceParameter(choices=DTYPE_MODES, default='compact')
+    # Обрабатывать ли датасеты совмещенной задачей FusedPipelineTask вместо Шагов 2a-4
+    fused = luigi.BoolParameter(default=False)
+
+    def datasets(self):
+        names = list(self.dataset_names)
+        if self.dataset_names_file:
+            with open(self.dataset_names_file, 'r') as f:
+                # Пустые строки и комментарии пропускаем
+                names.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+        # Убираем повторы, сохраняя порядок
+        return list(dict.fromkeys(names))
+
+    def requires(self):
+        # Серия каждого датасета определяется автоматически. Скачивания ограничены ресурсом 'geo_download',
+        # поэтому с '--workers N' распаковка и обработка уже скачанных серий идут параллельно со скачиванием остальных
+        task_cls = FusedPipelineTask if self.fused else CleanupProjectTask
+        return [task_cls(data_dir=self.data_dir,
+                         dataset_name=name,
+                         dataset_series=series_prefix(name),
+                         output_format=self.output_format,
+                         dtypes=self.dtypes,
+                         readme_dir=os.path.join(self.data_dir, name))
+                for name in self.datasets()]
+
+
 if __name__ == "__main__":
     luigi.run()
\ No newline at end of file
@@ -0,0 +1,137 @@
+import hashlib
+import http.server
+import os
+import re
+import threading
+
+import pytest
+
+import bondareva_pipeline as pipeline
+
+PAYLOAD = bytes(range(256)) * 4096  # 1 МБ "архива"
+
+
+# Локальная замена сервера GEO: отдает PAYLOAD с ETag, поддерживает Range и If-Range.
+# truncate_at -- оборвать ответ после стольких байтов, сообщив полный Content-Length
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+    payload = PAYLOAD
+    etag = '"v1"'
+    truncate_at = None
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        start = 0
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range', self.etag) == self.etag:
+            start = int(match.group(1))
+            if start >= len(self.payload):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(self.payload) - 1}/{len(self.payload)}')
+        else:
+            self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.payload) - start))
+        self.end_headers()
+        body = self.payload[start:]
+        if self.truncate_at is not None:
+            body = body[:self.truncate_at]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    handler = type('Handler', (ArchiveHandler,), {'requests': []})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def download_task(tmp_path, server):
+    return pipeline.DownloadDataset(data_dir=str(tmp_path), dataset_name='GSE68849', dataset_series='GSE68nnn',
+                                    base_url=f'http://127.0.0.1:{server.server_port}', chunk_size=64 * 1024)
+
+
+def write_part(task, data, validator='"v1"'):
+    with open(task.part_path(), 'wb') as f:
+        f.write(data)
+    with open(task.validator_path(), 'w') as f:
+        f.write(validator + '\n')
+
+
+def assert_downloaded(task, payload=PAYLOAD):
+    with open(task.output().path, 'rb') as f:
+        assert f.read() == payload
+    assert task.read_checksum() == (hashlib.sha256(payload).hexdigest(), len(payload))
+    assert not os.path.exists(task.part_path())
+    assert not os.path.exists(task.validator_path())
+    assert task.complete()
+
+
+def test_download_writes_checksum(tmp_path, server):
+    task = download_task(tmp_path, server)
+    task.run()
+    assert_downloaded(task)
+    assert 'Range' not in server.RequestHandlerClass.requests[0]
+
+
+def test_download_resumes_from_part(tmp_path, server):
+    task = download_task(tmp_path, server)
+    write_part(task, PAYLOAD[:300000])
+    task.run()
+    assert_downloaded(task)
+    headers = server.RequestHandlerClass.requests[0]
+    assert headers['Range'] == 'bytes=300000-'
+    assert headers['If-Range'] == '"v1"'
+
+
+def test_download_restarts_when_archive_changed(tmp_path, server):
+    task = download_task(tmp_path, server)
+    # .part от прежней версии архива: сервер игнорирует Range и отдает новый архив целиком
+    write_part(task, b'x' * 300000, validator='"v0"')
+    task.run()
+    assert_downloaded(task)
+
+
+def test_download_restarts_on_416(tmp_path, server):
+    task = download_task(tmp_path, server)
+    write_part(task, PAYLOAD + b'garbage')
+    task.run()
+    assert_downloaded(task)
+    ranges = [h.get('Range') for h in server.RequestHandlerClass.requests]
+    assert ranges == [f'bytes={len(PAYLOAD) + 7}-', None]
+
+
+def test_download_without_validator_restarts(tmp_path, server):
+    task = download_task(tmp_path, server)
+    with open(task.part_path(), 'wb') as f:
+        f.write(b'x' * 300000)
+    task.run()
+    assert_downloaded(task)
+    assert 'Range' not in server.RequestHandlerClass.requests[0]
+
+
+def test_truncated_download_keeps_part(tmp_path, server):
+    task = download_task(tmp_path, server)
+    server.RequestHandlerClass.truncate_at = 400000
+    with pytest.raises(Exception):
+        task.run()
+    assert not task.output().exists()
+    assert task.read_checksum() is None
+    # Последний неполный кусок при обрыве может не попасть в .part -- он будет скачан при докачке
+    part_size = os.path.getsize(task.part_path())
+    assert 0 < part_size <= 400000
+
+    # Повторный запуск докачивает только недостающее
+    server.RequestHandlerClass.truncate_at = None
+    task.run()
+    assert_downloaded(task)
+    assert server.RequestHandlerClass.requests[-1]['Range'] == f'bytes={part_size}-'